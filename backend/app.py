@@ -3,23 +3,67 @@
 # Deterministic + Explainable
 # =====================================================
 
-from flask import Flask, request, jsonify
+import os
+
+# Pin OpenMP/MKL threads before onnxruntime (and torch, during exports)
+# are imported, so every BLAS backend agrees on the thread count. An
+# explicit OMP_NUM_THREADS (e.g. from gunicorn.conf.py) wins.
+INFERENCE_THREADS = int(os.environ.get("OMP_NUM_THREADS", os.cpu_count() or 4))
+os.environ["OMP_NUM_THREADS"] = str(INFERENCE_THREADS)
+
+from flask import Flask, request
 from flask_cors import CORS
-from transformers import pipeline
+from transformers import AutoConfig, AutoTokenizer
+import onnxruntime
 from PIL import Image
-import pytesseract
+import orjson
+import numpy as np
 import io
 import random
+import sys
+import shutil
+import tempfile
 import logging
-import json
+import re
+import functools
+import threading
+import queue
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import time
+from pathlib import Path
 
 # =====================================================
 # CONFIG
 # =====================================================
 
-pytesseract.pytesseract.tesseract_cmd = (
-    r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+BASE_DIR = Path(__file__).resolve().parent
+DATA_DIR = BASE_DIR / "data"
+MODELS_DIR = BASE_DIR / "models"
+
+# Point ECOSTYLE_BERT_MODEL at a smaller student checkpoint (e.g. a
+# distilled DistilBERT with the same "environmental" label) to serve it
+# instead; each model gets its own quantized export directory.
+BERT_MODEL_ID = os.getenv(
+    "ECOSTYLE_BERT_MODEL",
+    "ESGBERT/EnvironmentalBERT-environmental"
 )
+BERT_QUANTIZED_DIR = str(
+    MODELS_DIR / (BERT_MODEL_ID.strip("/").replace("/", "--") + "-int8")
+)
+BERT_QUANTIZED_FILE = "model_quantized.onnx"
+BERT_MAX_LENGTH = 128
+BERT_MAX_CHARS = 2000
+
+CLAIM_CACHE_SIZE = 2048
+
+MAX_BATCH = 16
+BATCH_WINDOW_SECONDS = 0.010
+BATCH_TIMEOUT_SECONDS = 5.0
+CLASSIFIER_RETRY_SECONDS = 30
+
+OCR_MAX_EDGE = 1600
+
+DEBUG_ENABLED = os.getenv("ECOSTYLE_DEBUG") == "1"
 
 MAX_ECOSCORE = 30
 ENV_CLAIM_BONUS = 2
@@ -45,20 +89,40 @@ CORS(
     supports_credentials=True
 )
 
+def ojson(data, status=200):
+    # orjson serializes straight to bytes, much faster than jsonify.
+    return app.response_class(
+        orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype="application/json"
+    )
+
 # =====================================================
 # DEBUG LOG CAPTURE (FOR FRONTEND)
 # =====================================================
 
-def new_debug_logger():
-    return {
-        "agent": [],
-        "scoring": [],
-        "system": []
-    }
-
-def log(debug, channel, message):
-    debug[channel].append(message)
-    logger.info(message)
+# Per-request traces are opt-in (ECOSTYLE_DEBUG=1); otherwise log()
+# is a no-op and responses carry no debugLogs. Messages take %-style
+# args so nothing is formatted unless tracing is on.
+if DEBUG_ENABLED:
+    def new_debug_logger():
+        return {
+            "agent": [],
+            "scoring": [],
+            "system": []
+        }
+
+    def log(debug, channel, message, *args):
+        if args:
+            message = message % args
+        debug[channel].append(message)
+        logger.info(message)
+else:
+    def new_debug_logger():
+        return None
+
+    def log(debug, channel, message, *args):
+        pass
 
 # =====================================================
 # LOAD MODEL
@@ -66,15 +130,216 @@ def log(debug, channel, message):
 
 logger.info("🚀 Starting EcoStyle Agent backend")
 
-try:
-    claim_classifier = pipeline(
-        "text-classification",
-        model="ESGBERT/EnvironmentalBERT-environmental"
+# Runs the quantized model straight on an ONNX Runtime session, skipping
+# the transformers pipeline. Only the "environmental" class matters, so
+# it returns that class's probability per input text.
+class OnnxClaimClassifier:
+    def __init__(self, session, tokenizer, label2id):
+        self.session = session
+        self.tokenizer = tokenizer
+        self.env_index = label2id["environmental"]
+        self.input_names = [i.name for i in session.get_inputs()]
+
+    def __call__(self, texts):
+        # Claim detection only needs the opening tokens; truncating long
+        # OCR text keeps attention cost from growing quadratically. Texts
+        # are padded only to the longest in the batch.
+        encoded = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=BERT_MAX_LENGTH,
+            return_tensors="np"
+        )
+        logits = self.session.run(
+            None,
+            {name: encoded[name].astype(np.int64) for name in self.input_names}
+        )[0]
+
+        # softmax(logits)[env] == 1 / sum(exp(logits - logits[env]))
+        env_logits = logits[:, self.env_index:self.env_index + 1]
+        env_scores = 1.0 / np.exp(logits - env_logits).sum(axis=-1)
+
+        return [float(score) for score in env_scores]
+
+def export_quantized_model():
+    # Export to ONNX and apply INT8 dynamic quantization so the
+    # matmuls run on VNNI int8 dot-product kernels instead of FP32.
+    # Everything is written to a staging directory that is renamed into
+    # place only once complete, so BERT_QUANTIZED_DIR either holds a
+    # full export or does not exist.
+    #
+    # optimum is imported here because it pulls in torch, which serving
+    # processes never need.
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    parent_dir = os.path.dirname(BERT_QUANTIZED_DIR)
+    os.makedirs(parent_dir, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=".export-", dir=parent_dir)
+
+    try:
+        ort_model = ORTModelForSequenceClassification.from_pretrained(
+            BERT_MODEL_ID,
+            export=True
+        )
+        ORTQuantizer.from_pretrained(ort_model).quantize(
+            save_dir=staging_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(
+                is_static=False,
+                per_channel=True
+            )
+        )
+        AutoTokenizer.from_pretrained(BERT_MODEL_ID).save_pretrained(
+            staging_dir
+        )
+
+        try:
+            os.replace(staging_dir, BERT_QUANTIZED_DIR)
+        except OSError:
+            # Another export finished first; keep its complete copy.
+            if not os.path.isdir(BERT_QUANTIZED_DIR):
+                raise
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+def ensure_quantized_model():
+    # One-off build step (`python app.py export`); gunicorn.conf.py starts
+    # it in the background once the server is bound. Requests never export.
+    if os.path.isdir(BERT_QUANTIZED_DIR):
+        logger.info("✅ ONNX INT8 export already present")
+        return
+
+    logger.info("📦 Exporting EnvironmentalBERT to ONNX INT8")
+    export_quantized_model()
+
+def load_claim_classifier():
+    if not os.path.isdir(BERT_QUANTIZED_DIR):
+        raise FileNotFoundError(
+            f"{BERT_QUANTIZED_DIR} missing; run `python app.py export` first"
+        )
+
+    # Fuse LayerNorm, GELU, attention and skip connections at load time.
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = (
+        onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+    session_options.intra_op_num_threads = INFERENCE_THREADS
+    session_options.inter_op_num_threads = 1
+
+    session = onnxruntime.InferenceSession(
+        os.path.join(BERT_QUANTIZED_DIR, BERT_QUANTIZED_FILE),
+        session_options,
+        providers=["CPUExecutionProvider"]
+    )
+
+    return OnnxClaimClassifier(
+        session,
+        AutoTokenizer.from_pretrained(BERT_QUANTIZED_DIR),
+        AutoConfig.from_pretrained(BERT_QUANTIZED_DIR).label2id
     )
-    logger.info("✅ EnvironmentalBERT loaded")
-except Exception as e:
-    logger.error(f"❌ EnvironmentalBERT load failed: {e}")
-    claim_classifier = None
+
+# The session is opened on the first request that needs it rather than
+# at import, so each gunicorn worker builds its own after fork. Opening
+# an existing export is quick; a failed load is retried after
+# CLASSIFIER_RETRY_SECONDS and the API reports 500 meanwhile.
+claim_classifier = None
+claim_classifier_retry_at = 0.0
+claim_classifier_lock = threading.Lock()
+
+def get_claim_classifier():
+    global claim_classifier, claim_classifier_retry_at
+
+    if claim_classifier is not None or time.monotonic() < claim_classifier_retry_at:
+        return claim_classifier
+
+    with claim_classifier_lock:
+        if claim_classifier is None and time.monotonic() >= claim_classifier_retry_at:
+            try:
+                claim_classifier = load_claim_classifier()
+                logger.info("✅ EnvironmentalBERT loaded (ONNX INT8)")
+                threading.Thread(target=_batch_worker, daemon=True).start()
+            except Exception as e:
+                logger.error(f"❌ EnvironmentalBERT load failed: {e}")
+                claim_classifier_retry_at = (
+                    time.monotonic() + CLASSIFIER_RETRY_SECONDS
+                )
+
+    return claim_classifier
+
+# =====================================================
+# CLAIM CLASSIFICATION (BATCHED + CACHED)
+# =====================================================
+
+# Concurrent requests are coalesced into one forward pass: each caller
+# enqueues (text, future) and a single worker drains up to MAX_BATCH
+# items within BATCH_WINDOW_SECONDS before running the classifier.
+batch_queue = queue.Queue()
+
+def _collect_batch():
+    batch = [batch_queue.get()]
+    deadline = time.monotonic() + BATCH_WINDOW_SECONDS
+
+    while len(batch) < MAX_BATCH:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(batch_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+
+    return batch
+
+def _batch_worker():
+    while True:
+        # Drop items whose caller already timed out and cancelled.
+        batch = [
+            (text, future)
+            for text, future in _collect_batch()
+            if future.set_running_or_notify_cancel()
+        ]
+        if not batch:
+            continue
+
+        texts = [text for text, _ in batch]
+
+        try:
+            outputs = claim_classifier(texts)
+        except Exception as e:
+            logger.error(f"❌ EnvironmentalBERT batch failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            continue
+
+        for (_, future), score in zip(batch, outputs):
+            future.set_result(score)
+
+def submit_claim(text):
+    future = Future()
+    batch_queue.put((text, future))
+    return future
+
+def classify_batched(text):
+    future = submit_claim(text)
+    try:
+        return future.result(timeout=BATCH_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        # No-op if the worker already picked it up; otherwise it is skipped.
+        future.cancel()
+        raise
+
+@functools.lru_cache(maxsize=CLAIM_CACHE_SIZE)
+def _classify_cached(text):
+    # Keyed on normalized text so repeated labels skip the forward pass.
+    return classify_batched(text)
+
+def classify_claim(text):
+    # The model gets the original casing; only whitespace is collapsed.
+    # Anything past BERT_MAX_CHARS would be truncated away as tokens
+    # anyway, so drop it before the tokenizer (and the cache key) see it.
+    normalized = " ".join(text.split())[:BERT_MAX_CHARS]
+    return _classify_cached(normalized)
 
 # =====================================================
 # LOAD FIBER DATABASE
@@ -82,19 +347,148 @@ except Exception as e:
 
 logger.info("📚 Loading fiber dataset")
 
-with open("data/fibers.json", "r", encoding="utf-8") as f:
-    material_database = json.load(f)
+material_database = orjson.loads(
+    (DATA_DIR / "fibers.json").read_bytes()
+)
+
+for key, fiber in material_database.items():
+    fiber["_aliases_lower"] = tuple(
+        alias.lower() for alias in fiber.get("includes", []) + [key]
+    )
+
+# Request-time lookups are dict hits instead of scans over the database.
+fiber_order = {key: index for index, key in enumerate(material_database)}
+fiber_choices = tuple(material_database.values())
+
+# The material entries and market sources in a response are static per
+# fiber, so they are serialized once here and embedded as pre-encoded
+# JSON fragments instead of being re-walked by orjson on every request.
+material_entries = {
+    key: orjson.Fragment(orjson.dumps({
+        "name": fiber["displayName"],
+        "ecoScore": fiber["ecoScore"],
+        "description": fiber["description"],
+        "biodegradable": fiber["biodegradable"],
+        "recyclable": fiber["recyclable"],
+        "certifications": fiber["certifications"]
+    }))
+    for key, fiber in material_database.items()
+}
+source_entries = {
+    key: tuple(
+        orjson.Fragment(orjson.dumps(source))
+        for source in fiber.get("sources", [])
+    )
+    for key, fiber in material_database.items()
+}
 
 logger.info(f"✅ Loaded {len(material_database)} fiber groups")
 
+def build_alias_index(database):
+    # An alias may belong to several fibers (e.g. "cashmere"), so each
+    # alias maps to the tuple of fiber keys it implies.
+    alias_keys = {}
+    for key, fiber in database.items():
+        for alias in fiber["_aliases_lower"]:
+            alias_keys.setdefault(alias, []).append(key)
+
+    return {alias: tuple(keys) for alias, keys in alias_keys.items()}
+
+def build_alias_pattern(aliases):
+    # One C-level scan over the text. Longest aliases come first so
+    # "organic cotton" wins over "cotton", and the lookarounds only
+    # accept whole words (\b fails next to keys like "cotton (organic)").
+    alternation = "|".join(
+        re.escape(alias) for alias in sorted(aliases, key=len, reverse=True)
+    )
+    return re.compile(r"(?<!\w)(" + alternation + r")(?!\w)")
+
+alias_to_keys = build_alias_index(material_database)
+alias_pattern = build_alias_pattern(alias_to_keys)
+
 # =====================================================
 # OCR
 # =====================================================
 
+# In-process Tesseract API, reused across requests. Tesseract is not
+# thread-safe, so access is serialized. The native handle is created on
+# first use (after any gunicorn fork), and if Tesseract is unavailable
+# OCR returns "" so the image route falls back as before.
+tess_api = None
+tess_lock = threading.Lock()
+
+def _get_tess_api():
+    # Caller must hold tess_lock.
+    global tess_api
+
+    if tess_api is None:
+        try:
+            # Imported here: tesserocr links libtesseract, and a missing
+            # library must not take down the text-only routes.
+            from tesserocr import PyTessBaseAPI, PSM
+            tess_api = PyTessBaseAPI(psm=PSM.AUTO)
+        except Exception as e:
+            logger.error(f"❌ Tesseract init failed: {e}")
+
+    return tess_api
+
+def otsu_threshold(histogram):
+    # Pick the grey level that maximizes between-class variance.
+    total = sum(histogram)
+    weighted_total = sum(level * count for level, count in enumerate(histogram))
+
+    background_count = 0
+    background_sum = 0
+    best_level, best_variance = 0, -1.0
+
+    for level, count in enumerate(histogram):
+        background_count += count
+        if background_count == 0:
+            continue
+        foreground_count = total - background_count
+        if foreground_count == 0:
+            break
+
+        background_sum += level * count
+        background_mean = background_sum / background_count
+        foreground_mean = (weighted_total - background_sum) / foreground_count
+        variance = (
+            background_count * foreground_count
+            * (background_mean - foreground_mean) ** 2
+        )
+
+        if variance > best_variance:
+            best_level, best_variance = level, variance
+
+    return best_level
+
+def preprocess_for_ocr(image):
+    # Grayscale, cap the long edge and binarize so Tesseract only
+    # sees the pixels it needs for label text. For JPEGs, draft() lets
+    # the decoder emit grayscale at a reduced scale, so large phone
+    # photos are never decoded at full resolution.
+    width, height = image.size
+    scale = min(1.0, OCR_MAX_EDGE / max(width, height))
+    target_size = (int(width * scale), int(height * scale))
+
+    image.draft("L", target_size)
+    image = image.convert("L")
+
+    if image.size != target_size:
+        image = image.resize(target_size, Image.LANCZOS)
+
+    threshold = otsu_threshold(image.histogram())
+    return image.point(lambda value: 255 if value > threshold else 0)
+
 def extract_text_from_image(image_bytes):
     try:
-        image = Image.open(io.BytesIO(image_bytes))
-        return pytesseract.image_to_string(image).strip()
+        image = preprocess_for_ocr(Image.open(io.BytesIO(image_bytes)))
+        with tess_lock:
+            api = _get_tess_api()
+            if api is None:
+                return ""
+            api.SetImage(image)
+            return api.GetUTF8Text().strip()
     except Exception as e:
         logger.error(f"❌ OCR error: {e}")
         return ""
@@ -104,7 +498,7 @@ def extract_text_from_image(image_bytes):
 # =====================================================
 
 def fabric_fallback_reasoning():
-    fiber = random.choice(list(material_database.values()))
+    fiber = random.choice(fiber_choices)
     return analyze_fabric_from_text(
         f"approximate fabric detected: {fiber['displayName']}",
         fallback_used=True,
@@ -118,42 +512,42 @@ def fabric_fallback_reasoning():
 def analyze_fabric_from_text(input_text, fallback_used=False, fallback_reason=None):
     debug = new_debug_logger()
 
-    if not claim_classifier:
-        return jsonify({"error": "EnvironmentalBERT unavailable"}), 500
+    if not get_claim_classifier():
+        return ojson({"error": "EnvironmentalBERT unavailable"}, 500)
 
     log(debug, "agent", "🧠 Agent reasoning started")
-    log(debug, "agent", f"📄 Input text: {input_text}")
+    log(debug, "agent", "📄 Input text: %s", input_text)
 
     lower_text = input_text.lower()
 
     # ---------- EnvironmentalBERT ----------
-    bert_results = claim_classifier(input_text)
+    try:
+        env_score = classify_claim(input_text)
+    except Exception as e:
+        # Batch timeouts and errors set on the future by the worker.
+        logger.error(f"❌ EnvironmentalBERT classification failed: {e!r}")
+        return ojson({"error": "EnvironmentalBERT busy, retry shortly"}, 503)
 
-    is_env_claim = any(
-        r["label"] == "environmental" and r["score"] > 0.5
-        for r in bert_results
-    )
+    is_env_claim = env_score > 0.5
 
-    log(debug, "agent", f"🌱 Environmental claim detected: {is_env_claim}")
+    log(debug, "agent", "🌱 Environmental claim detected: %s", is_env_claim)
 
     # ---------- Anchor Pillar ----------
     matched_fibers = []
     total_score = 0
     market_sources = []
 
-    for key, fiber in material_database.items():
-        aliases = fiber.get("includes", []) + [key]
-        if any(alias.lower() in lower_text for alias in aliases):
-            matched_fibers.append({
-                "name": fiber["displayName"],
-                "ecoScore": fiber["ecoScore"],
-                "description": fiber["description"],
-                "biodegradable": fiber["biodegradable"],
-                "recyclable": fiber["recyclable"],
-                "certifications": fiber["certifications"]
-            })
-            total_score += fiber["ecoScore"]
-            market_sources.extend(fiber.get("sources", []))
+    matched_keys = {
+        key
+        for alias in alias_pattern.findall(lower_text)
+        for key in alias_to_keys[alias]
+    }
+
+    for key in sorted(matched_keys, key=fiber_order.__getitem__):
+        fiber = material_database[key]
+        matched_fibers.append(material_entries[key])
+        total_score += fiber["ecoScore"]
+        market_sources.extend(source_entries[key])
 
     # ---------- SCORING ----------
     if not matched_fibers:
@@ -162,7 +556,7 @@ def analyze_fabric_from_text(input_text, fallback_used=False, fallback_reason=No
         log(debug, "scoring", "⚠️ No fiber matched — neutral baseline applied")
     else:
         avg_score = round(total_score / len(matched_fibers), 1)
-        log(debug, "scoring", f"📐 Anchor average score: {avg_score}")
+        log(debug, "scoring", "📐 Anchor average score: %s", avg_score)
 
         final_score = avg_score
 
@@ -171,18 +565,10 @@ def analyze_fabric_from_text(input_text, fallback_used=False, fallback_reason=No
             log(debug, "scoring", "➕ Environmental claim bonus applied")
 
         overall_score = round(min(final_score, MAX_ECOSCORE), 1)
+        summary = SCORE_SUMMARIES[score_bucket(overall_score)]
 
-        if overall_score >= 24:
-            summary = "Excellent Choice"
-        elif overall_score >= 18:
-            summary = "Good Choice"
-        elif overall_score >= 12:
-            summary = "Could Be Better"
-        else:
-            summary = "Consider Alternatives"
-
-    log(debug, "scoring", f"📊 Final EcoScore: {overall_score}/30")
-    log(debug, "system", f"🔎 Market sources returned: {len(market_sources)}")
+    log(debug, "scoring", "📊 Final EcoScore: %s/30", overall_score)
+    log(debug, "system", "🔎 Market sources returned: %s", len(market_sources))
 
     # ---------- RESPONSE ----------
     response = {
@@ -196,27 +582,40 @@ def analyze_fabric_from_text(input_text, fallback_used=False, fallback_reason=No
         "fallbackReason": fallback_reason,
         "environmentalBert": {
             "environmentalClaim": is_env_claim,
-            "raw": bert_results
+            "score": round(env_score, 4)
         },
-        "webVerification": market_sources,
-        "debugLogs": debug
+        "webVerification": market_sources
     }
 
-    return jsonify(response)
+    if DEBUG_ENABLED:
+        response["debugLogs"] = debug
+
+    return ojson(response)
 
 # =====================================================
 # RULE-BASED ADVICE
 # =====================================================
 
+# Indexed by score_bucket(): <12, 12-18, 18-24, >=24
+SCORE_SUMMARIES = (
+    "Consider Alternatives",
+    "Could Be Better",
+    "Good Choice",
+    "Excellent Choice"
+)
+
+SUSTAINABILITY_TIPS = (
+    "High environmental impact. Prefer materials like hemp, linen, or recycled fibers.",
+    "Moderate impact garment. Consider natural or recycled fibers next time.",
+    "A fairly sustainable option. Washing less and air-drying can further reduce impact.",
+    "Excellent choice. Focus on durability and mindful care to extend garment life."
+)
+
+def score_bucket(score):
+    return (score >= 12) + (score >= 18) + (score >= 24)
+
 def generate_sustainability_tip(score):
-    if score >= 24:
-        return "Excellent choice. Focus on durability and mindful care to extend garment life."
-    elif score >= 18:
-        return "A fairly sustainable option. Washing less and air-drying can further reduce impact."
-    elif score >= 12:
-        return "Moderate impact garment. Consider natural or recycled fibers next time."
-    else:
-        return "High environmental impact. Prefer materials like hemp, linen, or recycled fibers."
+    return SUSTAINABILITY_TIPS[score_bucket(score)]
 
 # =====================================================
 # API ROUTES
@@ -226,13 +625,13 @@ def generate_sustainability_tip(score):
 def analyze_text():
     data = request.get_json()
     if not data or not data.get("text"):
-        return jsonify({"error": "No text provided"}), 400
+        return ojson({"error": "No text provided"}, 400)
     return analyze_fabric_from_text(data["text"])
 
 @app.route("/analyze-image", methods=["POST"])
 def analyze_image():
     if "image" not in request.files:
-        return jsonify({"error": "No image uploaded"}), 400
+        return ojson({"error": "No image uploaded"}, 400)
 
     image_bytes = request.files["image"].read()
     extracted_text = extract_text_from_image(image_bytes)
@@ -247,5 +646,8 @@ def analyze_image():
 # =====================================================
 
 if __name__ == "__main__":
-    logger.info("✅ EcoStyle Agent running on http://127.0.0.1:5000")
-    app.run(debug=True, port=5000)
+    ensure_quantized_model()
+
+    if sys.argv[1:] != ["export"]:
+        logger.info("✅ EcoStyle Agent running on http://127.0.0.1:5000")
+        app.run(debug=True, port=5000)
@@ -0,0 +1,36 @@
+# =====================================================
+# Gunicorn config (production)
+# Run from backend/: gunicorn app:app
+# =====================================================
+
+import os
+import subprocess
+import sys
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+workers = max(2, (os.cpu_count() or 2) // 2)
+worker_class = "gthread"
+# Threads release the GIL in OCR and ONNX Runtime, and more in-flight
+# requests per worker give the claim batcher more to coalesce.
+threads = 16
+timeout = 30
+
+# Split the cores between workers so inference threads don't oversubscribe.
+raw_env = [f"OMP_NUM_THREADS={max(1, (os.cpu_count() or 2) // workers)}"]
+
+# Preloading shares the imported libraries and fiber index across
+# workers. The ONNX Runtime session and claim batching thread do not
+# survive fork(), but both are created lazily on the first request, so
+# each worker still builds its own.
+preload_app = True
+
+def when_ready(server):
+    # Build the ONNX INT8 export once per host, in a separate process,
+    # after the listening socket is bound so a slow first export can't
+    # blow the platform's boot timeout. Until it finishes, /analyze
+    # answers 500 and workers retry opening the model every
+    # CLASSIFIER_RETRY_SECONDS; an existing export makes this a no-op.
+    server.log.info("Starting EnvironmentalBERT export in the background")
+    subprocess.Popen([sys.executable, "app.py", "export"], cwd=chdir)